@@ -18,7 +18,7 @@ setup(
     url='https://github.com/dceoy/tmber.git',
     packages=find_packages(),
     include_package_data=True,
-    install_requires=['biopython', 'docopt', 'pandas', 'psutil', 'pyyaml'],
+    install_requires=['docopt', 'pandas', 'psutil', 'pyyaml'],
     entry_points={
         'console_scripts': ['tmber=tmber.cli:main']
     },
@@ -30,5 +30,5 @@ setup(
         'Programming Language :: Python :: 3',
         'Topic :: Software Development'
     ],
-    python_requires='>=3.6',
+    python_requires='>=3.8',
 )
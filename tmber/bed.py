@@ -1,14 +1,20 @@
 #!/usr/bin/env python
 
 import logging
+import mmap
 import os
 import re
+import shutil
 from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing.shared_memory import SharedMemory
 from pathlib import Path
 
-import pandas as pd
+import numpy as np
 
-from .util import print_log, read_fasta_and_generate_seq
+from .util import print_log, read_fasta_and_generate_seq, sort_chrom_names
+
+_SUFFIX_RE = re.compile(r'\.(gz|bz2|bgz)')
+_SHM_DIR = '/dev/shm'
 
 
 def create_bed_from_fa(fa_path, dest_dir_path, bgzip='bgzip',
@@ -19,51 +25,111 @@ def create_bed_from_fa(fa_path, dest_dir_path, bgzip='bgzip',
     fa = Path(fa_path).resolve()
     assert fa.is_file(), f'file not found: {fa}'
     bed = Path(dest_dir_path).resolve().joinpath(
-        re.sub(r'\.(gz|bz2|bgz)', '', Path(fa_path).name)
+        _SUFFIX_RE.sub('', Path(fa_path).name)
         + ('.autosome.' if human_autosome else '.')
         + ''.join(sorted(list(target_letter_set))) + '.bed'
     )
+    lut = bytes(int(chr(i) in target_letter_set) for i in range(256))
     autosomes = {f'chr{i}' for i in range(1, 23)}
     fs = list()
     with ProcessPoolExecutor(max_workers=n_cpu) as x:
-        for chrom, seq in read_fasta_and_generate_seq(path=str(fa)):
+        for chrom, seq in read_fasta_and_generate_seq(
+                path=str(fa), seq_ids=(autosomes if human_autosome else None),
+                n_cpu=n_cpu
+        ):
             seq_len = len(seq)
-            if human_autosome and chrom in autosomes:
+            if seq_len > 0:
                 print_log(
                     f'Detect the target letters:\t{chrom}\t({seq_len} bp)'
                 )
                 fs.append(
-                    x.submit(
-                        _identify_target_region, chrom, seq, target_letter_set
+                    _submit_target_region_detection(
+                        executor=x, chrom=chrom, sequence=seq, lut=lut
                     )
                 )
             else:
                 logger.info(f'Skip detection: {chrom} ({seq_len} bp)')
-        f_results = [f.result() for f in as_completed(fs)]
-    df_bed = pd.concat(
-        f_results, ignore_index=True, sort=False
-    ).sort_values(['chrom', 'chromStart', 'chromEnd'])
-    logger.debug(f'df_bed:{os.linesep}{df_bed}')
+        f_results = {
+            c: (s, e) for c, s, e in (f.result() for f in as_completed(fs))
+        }
     print_log(f'Write a BED file:\t{bed}')
-    df_bed.to_csv(bed, sep='\t', header=False, index=False)
-
-
-def _identify_target_region(chrom, sequence, target_letter_set):
-    bseq = pd.Series(list(sequence)).isin(target_letter_set).astype(int)
-    if bseq.sum() > 0:
-        return bseq.pipe(
-            lambda s: pd.DataFrame({
-                'chrom': chrom,
-                'chromStart': [
-                    *([0] if s.iloc[0] == 1 else list()),
-                    *s[s.diff() == 1].index
-                ],
-                'chromEnd': [
-                    *s[s.diff() == -1].index,
-                    *([len(s)] if s.iloc[-1] == 1 else list())
-                ]
-            })
+    with open(bed, 'w') as f:
+        for chrom in sort_chrom_names(f_results):
+            starts, ends = f_results.pop(chrom)
+            logger.debug(f'{chrom}: {starts.size} regions')
+            _write_bed_regions(f=f, chrom=chrom, starts=starts, ends=ends)
+
+
+def _write_bed_regions(f, chrom, starts, ends):
+    f.write(
+        ''.join(
+            f'{chrom}\t{s}\t{e}\n'
+            for s, e in zip(starts.tolist(), ends.tolist())
         )
+    )
+
+
+def _submit_target_region_detection(executor, chrom, sequence, lut):
+    shm = _put_sequence_on_shared_memory(sequence=sequence)
+    if shm is None:
+        logger = logging.getLogger(__name__)
+        logger.info(f'Insufficient shared memory for {chrom}; pass bytes')
+        return executor.submit(_identify_target_region, chrom, sequence, lut)
+    try:
+        f = executor.submit(
+            _identify_target_region_on_shared_memory, chrom, shm.name,
+            len(sequence), lut
+        )
+    except BaseException:
+        _release_shared_memory(shm=shm)
+        raise
+    else:
+        f.add_done_callback(lambda _: _release_shared_memory(shm=shm))
+        return f
+
+
+def _put_sequence_on_shared_memory(sequence):
+    if (
+        os.path.isdir(_SHM_DIR)
+        and shutil.disk_usage(_SHM_DIR).free < len(sequence) + mmap.PAGESIZE
+    ):
+        return None
     else:
+        shm = SharedMemory(create=True, size=len(sequence))
+        shm.buf[:len(sequence)] = sequence
+        return shm
+
+
+def _release_shared_memory(shm):
+    shm.close()
+    shm.unlink()
+
+
+def _identify_target_region_on_shared_memory(chrom, shm_name, seq_len, lut):
+    shm = SharedMemory(name=shm_name)
+    try:
+        return _identify_target_region(
+            chrom=chrom, sequence=shm.buf[:seq_len], lut=lut
+        )
+    finally:
+        shm.close()
+
+
+def _identify_target_region(chrom, sequence, lut):
+    starts, ends = _find_target_runs(
+        buf=np.frombuffer(sequence, dtype=np.uint8),
+        lut=np.frombuffer(lut, dtype=np.uint8)
+    )
+    if starts.size == 0:
         logger = logging.getLogger(__name__)
         logger.info(f'Target letters not detected: {chrom}')
+    return chrom, starts, ends
+
+
+def _find_target_runs(buf, lut):
+    padded = np.zeros(buf.size + 2, dtype=np.uint8)
+    np.take(lut, buf, out=padded[1:-1])
+    edges = np.flatnonzero(padded[1:] != padded[:-1]).astype(np.int64)
+    return (
+        np.ascontiguousarray(edges[0::2]), np.ascontiguousarray(edges[1::2])
+    )
@@ -8,7 +8,7 @@ Usage:
     tmber bed [--debug|--info] [--cpus=<int>] [--human-autosome]
         [--target-letters=<str>] [--dest-dir=<path>] <fa_path>
     tmber tmb [--debug|--info] [--cpus=<int>] [--include-filtered]
-        [--sample=<name>] [--min-af=<float>] [--max-af=<float>]
+        [--dedupe] [--sample=<name>] [--min-af=<float>] [--max-af=<float>]
         [--dest-dir=<path>] <vcf_path> <bed_path>...
 
 Commands:
@@ -25,6 +25,7 @@ Options:
                         Specify nucleic acid codes to include [default: ACGT]
     --dest-dir=<path>   Specify a path to an output TSV file [default: .]
     --include-filtered  Include filtered variants (`PASS` or `.`)
+    --dedupe            Drop duplicated variant records in a VCF file
     --sample=<name>     Specify a sample column including AF in a VCF file
     --min-af=<float>    Specify the min AF limit
     --max-af=<float>    Specify the max AF limit
@@ -60,13 +61,12 @@ def main():
         datefmt='%Y-%m-%d %H:%M:%S', level=lv
     )
     logger = logging.getLogger(__name__)
-    logger.debug(f'args:{os.linesep}{args}')
+    logger.debug('args:%s%s', os.linesep, args)
     n_cpu = int(args['--cpus'] or cpu_count())
     logger.info(f'n_cpu: {n_cpu}')
     if args['bed']:
         create_bed_from_fa(
             fa_path=args['<fa_path>'], dest_dir_path=args['--dest-dir'],
-            bgzip=fetch_executable('bgzip'),
             human_autosome=args['--human-autosome'],
             target_letters=args['--target-letters'], n_cpu=n_cpu
         )
@@ -76,9 +76,9 @@ def main():
         calculate_tmb(
             vcf_path=args['<vcf_path>'], bed_paths=args['<bed_path>'],
             dest_dir_path=args['--dest-dir'],
-            bedtools=fetch_executable('bedtools'),
             bgzip=fetch_executable('bgzip'),
             include_filtered=args['--include-filtered'],
+            dedupe=args['--dedupe'],
             sample_name=args['--sample'],
             min_af=(float(args['--min-af']) if args['--min-af'] else None),
             max_af=(float(args['--max-af']) if args['--max-af'] else None),
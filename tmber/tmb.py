@@ -3,18 +3,41 @@
 import logging
 import os
 import re
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
 from pathlib import Path
 
 import numpy as np
 import pandas as pd
 
-from .util import print_log, read_bed, read_vcf
+from .util import print_log, read_bed, read_vcf_in_chunks, sort_chrom_names
 
+_SUFFIX_RE = re.compile(r'\.(gz|bz2|bgz)')
+_END_RE = re.compile(r'(?:^|;)END=([0-9]+)')
+_VARIANT_TYPES = [
+    'SNV', 'deletion', 'insertion', 'delins', 'structural_variant',
+    'duplication', 'inversion', 'copy_number_variation',
+    'no_sequence_alteration'
+]
+_TMB_VARIANT_TYPES = [
+    t for t in _VARIANT_TYPES if t != 'no_sequence_alteration'
+]
+# indexed by [min(len(REF), 2)][min(len(ALT0), 2)][REF[0] == ALT0[0]],
+# where ALT0 is the first ALT allele
+_SMALL_VARIANT_TYPES = np.array(
+    [
+        [['', ''], ['', ''], ['', '']],
+        [['', ''], ['SNV', 'SNV'], ['delins', 'insertion']],
+        [['', ''], ['delins', 'deletion'], ['delins', 'delins']]
+    ],
+    dtype=object
+)
 
-def calculate_tmb(vcf_path, bed_paths, dest_dir_path='.', bedtools='bedtools',
+
+def calculate_tmb(vcf_path, bed_paths, dest_dir_path='.', bedtools=None,
                   bgzip='bgzip', include_filtered=False, sample_name=None,
-                  min_af=None, max_af=None, n_cpu=1):
+                  min_af=None, max_af=None, dedupe=False,
+                  chunk_size=1000000, n_cpu=1):
     logger = logging.getLogger(__name__)
     vcf = Path(vcf_path).resolve()
     assert vcf.is_file(), f'file not found: {vcf}'
@@ -23,7 +46,7 @@ def calculate_tmb(vcf_path, bed_paths, dest_dir_path='.', bedtools='bedtools',
         assert bed.is_file(), f'file not found: {bed}'
     output_alt_tsv = Path(dest_dir_path).resolve().joinpath(
         '.'.join([
-            re.sub(r'\.(gz|bz2|bgz)', '', Path(vcf_path).name),
+            _SUFFIX_RE.sub('', Path(vcf_path).name),
             ('' if min_af is None and max_af is None else str(sample_name)),
             '_n_'.join([
                 '{0}{1:0>3}'.format(k, int(v * 1000)) for k, v
@@ -35,146 +58,221 @@ def calculate_tmb(vcf_path, bed_paths, dest_dir_path='.', bedtools='bedtools',
     output_tmb_tsv = output_alt_tsv.parent.joinpath(
         Path(output_alt_tsv.stem).stem + '.tmb.tsv'
     )
-    df_vcf = read_vcf(
-        path=str(vcf), sample_name=sample_name, min_af=min_af, max_af=max_af,
-        include_filtered=include_filtered, bgzip=bgzip, n_cpu=n_cpu
-    )
-    logger.debug(f'df_vcf:{os.linesep}{df_vcf}')
-    bed_dfs = dict()
-    df_size = pd.DataFrame(columns=['bed_name', 'bed_size'])
-    for b in beds:
-        df_bed = read_bed(path=str(b), merge=True, bedtools=bedtools)
-        logger.debug(f'df_bed:{os.linesep}{df_bed}')
-        assert df_bed.shape[0] > 0
-        bed_dfs[b.name] = df_bed
-        bed_size = (df_bed['chromEnd'] - df_bed['chromStart']).sum()
-        logger.debug(f'bed_size: {bed_size}')
-        assert bed_size > 0
-        df_size = pd.concat([
-            df_size, pd.DataFrame([{'bed_name': b.name, 'bed_size': bed_size}])
-        ])
-    logger.debug(f'df_size:{os.linesep}{df_size}')
-    if df_vcf.shape[0] == 0:
-        logger.info('No variant detected.')
-        df_var = pd.DataFrame(
-            column=[
-                'bed_name', 'bed_size', 'variant_type', 'ref', 'alt',
-                'observed_alt_count'
-            ]
-        ).set_index(['bed_name', 'bed_size', 'variant_type', 'ref', 'alt'])
+    with ThreadPoolExecutor(max_workers=n_cpu) as x:
+        fs = {
+            x.submit(
+                _read_merged_bed, str(b), b.stat().st_mtime_ns, bedtools
+            ): b.name for b in beds
+        }
+        bed_tables = {fs[f]: f.result() for f in as_completed(fs)}
+        bed_names = sorted(bed_tables)
+        for k in bed_names:
+            df_bed, bed_size, _ = bed_tables[k]
+            logger.debug('df_bed:%s%s', os.linesep, df_bed)
+            assert df_bed.shape[0] > 0
+            logger.debug(f'bed_size: {bed_size}')
+            assert bed_size > 0
+        df_size = pd.DataFrame({
+            'bed_name': pd.Categorical(bed_names, categories=bed_names),
+            'bed_size': [bed_tables[k][1] for k in bed_names]
+        })
+        logger.debug('df_size:%s%s', os.linesep, df_size)
+        alt_counts = [
+            _tally_alt(
+                df_var=_convert_vcf_to_var(df_vcf=d, dedupe=dedupe),
+                bed_tables=bed_tables, bed_names=bed_names, executor=x
+            ) for d in read_vcf_in_chunks(
+                path=str(vcf), sample_name=sample_name, min_af=min_af,
+                max_af=max_af, include_filtered=include_filtered,
+                chunk_size=(None if dedupe else chunk_size), bgzip=bgzip,
+                n_cpu=n_cpu
+            )
+        ]
+    if alt_counts:
+        sr_alt = pd.concat(alt_counts).groupby(
+            level=['bed_name', 'ref', 'alt'], observed=True
+        ).sum()
     else:
-        df_var = df_vcf.assign(
-            chrom=lambda d: d['CHROM'].str.replace(
-                r'^(chr|)', 'chr', regex=True, flags=re.IGNORECASE
-            ),
-            pos_end=lambda d: np.where(
-                d['ALT'].str.startswith('<'),
-                d['INFO'].str.replace(
-                    r'^(.+;|)END=([0-9]+);.*$', r'\2', regex=True
-                ).pipe(
-                    lambda i: i.where(i.str.isdigit(), np.nan)
-                ).astype(float),
-                (d['POS'] + d['REF'].str.len() - 1).astype(float)
-            ).astype(int)
-        ).rename(
-            columns={'POS': 'pos_start', 'REF': 'ref', 'ALT': 'alt'}
-        )[['chrom', 'pos_start', 'pos_end', 'ref', 'alt']].drop_duplicates()
-        logger.debug(f'df_var:{os.linesep}{df_var}')
-        fs = list()
-        with ProcessPoolExecutor(max_workers=n_cpu) as x:
-            fs = [
-                x.submit(_tally_alt, df_var, v, k) for k, v in bed_dfs.items()
-            ]
-            f_results = [f.result() for f in as_completed(fs)]
-        df_alt = pd.concat(
-            f_results, ignore_index=True, sort=False
-        ).assign(
-            variant_type=lambda d: d[['ref', 'alt']].apply(
-                lambda r: _determine_sequence_ontology(ref=r[0], alt=r[1]),
-                axis=1
+        logger.info('No variant detected.')
+        sr_alt = pd.Series(
+            [], dtype=np.int64,
+            index=pd.MultiIndex.from_arrays(
+                [pd.Categorical([], categories=bed_names), [], []],
+                names=['bed_name', 'ref', 'alt']
             )
-        ).pipe(
-            lambda d: d.merge(df_size, on='bed_name', how='left')
-        ).set_index([
-            'bed_name', 'bed_size', 'variant_type', 'ref', 'alt'
-        ]).sort_index()
-    logger.debug(f'df_alt:{os.linesep}{df_alt}')
+        )
+    df_alt = sr_alt.to_frame(
+        name='observed_alt_count'
+    ).reset_index().assign(
+        variant_type=lambda d: _classify_variants(ref=d['ref'], alt=d['alt'])
+    ).pipe(
+        lambda d: d.merge(df_size, on='bed_name', how='left')
+    ).set_index([
+        'bed_name', 'bed_size', 'variant_type', 'ref', 'alt'
+    ]).sort_index()
+    logger.debug('df_alt:%s%s', os.linesep, df_alt)
     print_log(f'Write a TSV file:\t{output_alt_tsv}')
     df_alt.to_csv(output_alt_tsv, sep='\t')
-    df_tmb = df_alt.reset_index().pipe(
-        lambda d: pd.concat([
-            d[
-                d['variant_type'] != 'no_sequence_alteration'
-            ][['bed_name', 'bed_size', 'variant_type', 'observed_alt_count']],
-            *[
-                df_size.assign(variant_type=t, observed_alt_count=0) for t in [
-                    'SNV', 'deletion', 'insertion', 'delins',
-                    'structural_variant', 'duplication', 'inversion',
-                    'copy_number_variation'
-                ]
-            ]
-        ])
-    ).groupby([
-        'bed_name', 'bed_size', 'variant_type'
-    ])['observed_alt_count'].sum().to_frame().reset_index().pipe(
-        lambda d: pd.concat([
-            d,
-            d.groupby([
-                'bed_name', 'bed_size'
-            ])['observed_alt_count'].sum().to_frame().assign(
-                variant_type='total'
-            ).reset_index()[d.columns]
-        ])
-    ).assign(
-        mutations_per_mb=lambda d:
-        (d['observed_alt_count'] / d['bed_size'] * 1000000)
-    ).set_index(['bed_name', 'bed_size', 'variant_type'])
-    logger.debug(f'df_tmb:{os.linesep}{df_tmb}')
+    df_count = df_alt.groupby(
+        ['bed_name', 'bed_size', 'variant_type'], observed=True
+    )['observed_alt_count'].sum().unstack(fill_value=0).reindex(
+        index=pd.MultiIndex.from_frame(df_size),
+        columns=sorted(_TMB_VARIANT_TYPES), fill_value=0
+    ).rename_axis(columns='variant_type')
+    df_tmb = pd.concat([
+        df_count.stack(),
+        df_count.sum(axis=1).to_frame(name='total').rename_axis(
+            columns='variant_type'
+        ).stack()
+    ]).to_frame(name='observed_alt_count').assign(
+        mutations_per_mb=lambda d: (
+            d['observed_alt_count']
+            / d.index.get_level_values('bed_size') * 1000000
+        )
+    )
+    logger.debug('df_tmb:%s%s', os.linesep, df_tmb)
     print_log(f'Write a TSV file:\t{output_tmb_tsv}')
     df_tmb.to_csv(output_tmb_tsv, sep='\t')
 
 
-def _tally_alt(df_var, df_bed, bed_name):
-    return df_var[
-        df_var[['chrom', 'pos_start', 'pos_end']].apply(
-            lambda r: (
-                (df_bed['chrom'] == r[0])
-                & (df_bed['chromStart'] < r[1])
-                & (df_bed['chromEnd'] >= r[2])
-            ).any(),
-            axis=1
+def _normalize_chrom_names(chroms):
+    codes, uniques = pd.factorize(chroms)
+    names = np.array(
+        [('chr' + (c[3:] if c[:3].lower() == 'chr' else c)) for c in uniques],
+        dtype=object
+    )
+    return pd.Categorical(
+        names[codes], categories=sort_chrom_names(names), ordered=True
+    )
+
+
+def _calculate_pos_end(df):
+    pos_end = (df['POS'] + df['REF'].str.len() - 1).to_numpy(dtype=np.int64)
+    symbolic = df['ALT'].str.startswith('<').to_numpy(dtype=bool)
+    if symbolic.any():
+        sv_end = df['INFO'][symbolic].str.extract(
+            _END_RE, expand=False
+        ).astype(float).to_numpy()
+        i = np.flatnonzero(symbolic)[~np.isnan(sv_end)]
+        pos_end[i] = sv_end[~np.isnan(sv_end)].astype(np.int64)
+    return pos_end
+
+
+def _convert_vcf_to_var(df_vcf, dedupe=False):
+    logger = logging.getLogger(__name__)
+    logger.debug('df_vcf:%s%s', os.linesep, df_vcf)
+    df_var = df_vcf.assign(
+        chrom=lambda d: _normalize_chrom_names(chroms=d['CHROM']),
+        pos_end=lambda d: _calculate_pos_end(df=d)
+    ).rename(
+        columns={'POS': 'pos_start', 'REF': 'ref', 'ALT': 'alt'}
+    )[['chrom', 'pos_start', 'pos_end', 'ref', 'alt']].pipe(
+        lambda d: (d.drop_duplicates() if dedupe else d)
+    )
+    logger.debug('df_var:%s%s', os.linesep, df_var)
+    return df_var
+
+
+def _tally_alt(df_var, bed_tables, bed_names, executor):
+    var_chroms = df_var['chrom'].array
+    var_starts = df_var['pos_start'].to_numpy()
+    var_ends = df_var['pos_end'].to_numpy()
+    fs = {
+        executor.submit(
+            _detect_alt_in_bed, var_chroms, var_starts, var_ends,
+            bed_tables[k][2]
+        ): k for k in bed_names
+    }
+    hits = {fs[f]: f.result() for f in as_completed(fs)}
+    return df_var[['ref', 'alt']].iloc[
+        np.concatenate([hits[k] for k in bed_names])
+    ].assign(
+        bed_name=pd.Categorical.from_codes(
+            np.repeat(
+                np.arange(len(bed_names)), [hits[k].size for k in bed_names]
+            ),
+            categories=bed_names
+        )
+    ).groupby(['bed_name', 'ref', 'alt'], observed=True).size()
+
+
+@lru_cache(maxsize=32)
+def _read_merged_bed(bed_path, mtime_ns, bedtools):
+    df_bed = read_bed(
+        path=bed_path, merge=True,
+        columns=['chrom', 'chromStart', 'chromEnd'], bedtools=bedtools
+    )
+    bed_size = int(
+        (
+            df_bed['chromEnd'].to_numpy() - df_bed['chromStart'].to_numpy()
+        ).sum(dtype=np.int64)
+    )
+    return df_bed, bed_size, _index_bed_intervals(df_bed=df_bed)
+
+
+def _index_bed_intervals(df_bed):
+    return {
+        c: (
+            d['chromStart'].to_numpy(),
+            np.maximum.accumulate(d['chromEnd'].to_numpy())
+        ) for c, d in df_bed.sort_values(['chrom', 'chromStart']).groupby(
+            'chrom', observed=True, sort=False
+        )
+    }
+
+
+def _detect_alt_in_bed(var_chroms, var_starts, var_ends, bed_index):
+    codes = var_chroms.codes
+    o = np.argsort(codes, kind='stable')
+    bounds = np.searchsorted(
+        codes[o], np.arange(len(var_chroms.categories) + 1)
+    )
+    hits = [np.array([], dtype=np.int64)]
+    for i, c in enumerate(var_chroms.categories):
+        if c in bed_index:
+            bed_starts, bed_max_ends = bed_index[c]
+            v = o[bounds[i]:bounds[i + 1]]
+            j = np.searchsorted(bed_starts, var_starts[v], side='left') - 1
+            hits.append(
+                v[(j >= 0) & (bed_max_ends[np.maximum(j, 0)] >= var_ends[v])]
+            )
+    return np.concatenate(hits)
+
+
+def _classify_variants(ref, alt):
+    alt0 = alt.str.split(',', n=1).str[0]
+    len_ref = ref.str.len().to_numpy(dtype=np.int64)
+    len_alt0 = alt0.str.len().to_numpy(dtype=np.int64)
+    first_eq = (ref.str[0] == alt0.str[0]).to_numpy(dtype=bool)
+    symbolic_types = alt.str.slice(0, 5).map(
+        {
+            f'<{k}{c}': v for k, v in [
+                ('DEL', 'deletion'), ('INS', 'insertion'),
+                ('DUP', 'duplication'), ('INV', 'inversion'),
+                ('CNV', 'copy_number_variation')
+            ] for c in '>:'
+        }
+    ).fillna('').to_numpy()
+    labels = np.select(
+        [
+            alt.str.contains(r'[\[\]]', regex=True).to_numpy(),
+            symbolic_types != '',
+            (alt == '.').to_numpy(), (alt == '*').to_numpy()
+        ],
+        [
+            'structural_variant', symbolic_types, 'no_sequence_alteration',
+            'deletion'
+        ],
+        default=_SMALL_VARIANT_TYPES[
+            np.minimum(len_ref, 2), np.minimum(len_alt0, 2),
+            first_eq.astype(np.int64)
+        ]
+    )
+    unsupported = (labels == '')
+    if unsupported.any():
+        i = np.flatnonzero(unsupported)[0]
+        raise ValueError(
+            f'unsupported REF/ALT: "{ref.iloc[i]}" / "{alt.iloc[i]}"'
         )
-    ].groupby(['ref', 'alt']).size().to_frame(
-        name='observed_alt_count'
-    ).reset_index().assign(bed_name=bed_name)
-
-
-def _determine_sequence_ontology(ref, alt):
-    if {'[', ']'} & set(alt):
-        return 'structural_variant'
-    elif alt.startswith(('<DEL>', '<DEL:')):
-        return 'deletion'
-    elif alt.startswith(('<INS>', '<INS:')):
-        return 'insertion'
-    elif alt.startswith(('<DUP>', '<DUP:')):
-        return 'duplication'
-    elif alt.startswith(('<INV>', '<INV:')):
-        return 'inversion'
-    elif alt.startswith(('<CNV>', '<CNV:')):
-        return 'copy_number_variation'
-    elif alt == '.':
-        return 'no_sequence_alteration'
-    elif alt == '*':
-        return 'deletion'
     else:
-        alt0 = alt.split(',', maxsplit=1)[0]
-        if len(ref) == 1 and len(alt0) == 1:
-            return 'SNV'
-        elif ref[0] == alt0[0] and len(ref) > 1 and len(alt0) == 1:
-            return 'deletion'
-        elif ref[0] == alt0[0] and len(ref) == 1 and len(alt0) > 1:
-            return 'insertion'
-        elif len(ref) >= 1 and len(alt0) >= 1:
-            return 'delins'
-        else:
-            raise ValueError(f'unsupported REF/ALT: "{ref}" / "{alt}"')
+        return pd.Categorical(labels, categories=sorted(_VARIANT_TYPES))
@@ -1,104 +1,211 @@
 #!/usr/bin/env python
 
 import bz2
+import csv
 import gzip
+import io
 import logging
+import mmap
 import os
+import re
+import shutil
 import subprocess
-from collections import OrderedDict
-from pathlib import Path
+from contextlib import contextmanager
+from functools import lru_cache, partial
 from pprint import pformat
 
+import numpy as np
 import pandas as pd
 import yaml
-from Bio import SeqIO
 
+try:
+    import pyarrow as pa
+    from pyarrow import compute as pc
+    from pyarrow import csv as pacsv
+except ImportError:
+    pa = None
+    pc = None
+    pacsv = None
+try:
+    import rapidgzip
+except ImportError:
+    rapidgzip = None
+try:
+    import indexed_bzip2
+except ImportError:
+    indexed_bzip2 = None
+try:
+    from yaml import CSafeDumper as YamlDumper
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeDumper as YamlDumper
+    from yaml import SafeLoader as YamlLoader
 
+_CHR_RE = re.compile(r'^chr', re.IGNORECASE)
+_BED_HEADER_PREFIXES = ('browser', 'track', '#')
+
+
+@lru_cache(maxsize=None)
 def fetch_executable(cmd, ignore_errors=False):
-    executables = [
-        cp for cp in [
-            str(Path(p).joinpath(cmd))
-            for p in os.environ['PATH'].split(os.pathsep)
-        ] if os.access(cp, os.X_OK)
-    ]
-    if executables:
-        return executables[0]
+    executable = shutil.which(cmd)
+    if executable:
+        return executable
     elif ignore_errors:
         return None
     else:
         raise RuntimeError(f'command not found: {cmd}')
 
 
-def read_fasta_and_generate_seq(path):
+def sort_chrom_names(chroms):
+    return sorted(
+        set(chroms),
+        key=lambda c: (
+            lambda n: ((0, int(n), '') if n.isdigit() else (1, 0, n))
+        )(_CHR_RE.sub('', c))
+    )
+
+
+def read_fasta_and_generate_seq(path, seq_ids=None, n_cpu=1):
     print_log(f'Read a FASTA file:\t{path}')
-    if path.endswith('.gz'):
-        f = gzip.open(path, 'rt')
-    elif path.endswith('.bz2'):
-        f = bz2.open(path, 'rt')
+    if path.endswith(('.gz', '.bz2')) or os.path.getsize(path) == 0:
+        yield from _generate_seq_from_fasta_lines(
+            path=path, seq_ids=seq_ids, n_cpu=n_cpu
+        )
     else:
-        f = open(path, 'r')
-    for s in SeqIO.parse(f, 'fasta'):
-        yield s.id, s.seq
-    f.close()
+        yield from _generate_seq_from_fasta_mmap(path=path, seq_ids=seq_ids)
+
+
+def _generate_seq_from_fasta_mmap(path, seq_ids=None):
+    logger = logging.getLogger(__name__)
+    with open(path, 'rb') as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        if mm[:1] == b'>':
+            start = 0
+        else:
+            i = mm.find(b'\n>')
+            start = (-1 if i < 0 else i + 1)
+        while start >= 0:
+            header_end = mm.find(b'\n', start)
+            if header_end < 0:
+                header_end = len(mm)
+            end = mm.find(b'\n>', header_end)
+            seq_id = (
+                mm[(start + 1):header_end].split(maxsplit=1) or [b'']
+            )[0].decode()
+            if seq_ids is None or seq_id in seq_ids:
+                yield seq_id, mm[
+                    header_end:(len(mm) if end < 0 else end)
+                ].translate(None, b' \t\r\n')
+            else:
+                logger.info(f'Skip a sequence: {seq_id}')
+            start = (end + 1 if end >= 0 else -1)
+
+
+def _generate_seq_from_fasta_lines(path, seq_ids=None, n_cpu=1):
+    with _open_and_stream_file(path=path, bgzip=None, n_cpu=n_cpu) as f:
+        seq_id = None
+        lines = list()
+        for line in f:
+            if not line.startswith(b'>'):
+                if lines is not None:
+                    lines.append(line)
+            else:
+                if seq_id is not None and lines is not None:
+                    yield seq_id, b''.join(lines).translate(None, b' \t\r\n')
+                seq_id = (line[1:].split(maxsplit=1) or [b''])[0].decode()
+                if seq_ids is None or seq_id in seq_ids:
+                    lines = list()
+                else:
+                    logger = logging.getLogger(__name__)
+                    logger.info(f'Skip a sequence: {seq_id}')
+                    lines = None
+        if seq_id is not None and lines is not None:
+            yield seq_id, b''.join(lines).translate(None, b' \t\r\n')
 
 
 def print_yml(data):
     logger = logging.getLogger(__name__)
     logger.debug(data)
-    print(yaml.dump(data))
+    print(yaml.dump(data, Dumper=YamlDumper))
 
 
-def read_bed(path, merge=True, **kwargs):
+def read_bed(path, merge=True, columns=None, **kwargs):
     print_log(
         'Read a BED file{0}:\t{1}'.format(
             (' (merging intervals)' if merge else ''), path
         )
     )
     dtype = {
-        'chrom': str, 'chromStart': int, 'chromEnd': int, 'name': str,
-        'score': int, 'strand': str, 'thickStart': int, 'thickEnd': int,
+        'chrom': 'category', 'chromStart': 'int64', 'chromEnd': 'int64',
+        'name': str,
+        'score': int, 'strand': 'category', 'thickStart': int,
+        'thickEnd': int,
         'itemRgb': str, 'blockCount': int, 'blockSizes': int,
         'blockStarts': int, 'ADDITIONAL': str
     }
-    bed_lines = [d for d in _stream_bed_lines(path=path, **kwargs)]
-    return (
-        pd.DataFrame(bed_lines) if bed_lines else pd.DataFrame()
+    df_bed = _read_bed_table(
+        path=path, merge=merge, columns=columns, **kwargs
+    )
+    int32 = np.iinfo(np.int32)
+    return df_bed.astype(
+        dtype={k: v for k, v in dtype.items() if k in df_bed.columns}
     ).pipe(
-        lambda d:
-        d.astype(dtype={k: v for k, v in dtype.items() if k in d.columns})
+        lambda d: d.astype(
+            dtype={
+                k: 'int32' for k in ['chromStart', 'chromEnd']
+                if k in d.columns and d[k].between(int32.min, int32.max).all()
+            }
+        )
+    )
+
+
+def read_vcf(path, chunk_size=500000, **kwargs):
+    df_vcfs = list(
+        read_vcf_in_chunks(path=path, chunk_size=chunk_size, **kwargs)
     )
+    if not df_vcfs:
+        return pd.DataFrame()
+    else:
+        return pd.concat(df_vcfs, ignore_index=True).astype(
+            dtype={
+                k: 'category' for k, v in df_vcfs[0].dtypes.items()
+                if isinstance(v, pd.CategoricalDtype)
+            }
+        )
 
 
-def read_vcf(path, sample_name=None, min_af=None, max_af=None,
-             include_filtered=False, **kwargs):
+def read_vcf_in_chunks(path, sample_name=None, min_af=None, max_af=None,
+                       include_filtered=False, chunk_size=None, **kwargs):
     print_log(
         'Read a VCF file ({0} filtered variants):\t{1}'.format(
             ('including' if include_filtered else 'excluding'), path
         )
     )
     dtype = {
-        'CHROM': str, 'POS': int, 'ID': str, 'REF': str, 'ALT': str,
-        'QUAL': str, 'FILTER': str, 'INFO': str, 'FORMAT': str
+        'CHROM': 'category', 'POS': int, 'ID': str, 'REF': str, 'ALT': str,
+        'QUAL': str, 'FILTER': 'category', 'INFO': str, 'FORMAT': str
     }
-    vcf_lines = [d for d in _stream_vcf_lines(path=path, **kwargs)]
-    if not vcf_lines:
-        return pd.DataFrame()
-    else:
-        df_vcf = pd.DataFrame(vcf_lines).pipe(
-            lambda d:
-            d.astype(dtype={k: v for k, v in dtype.items() if k in d.columns})
+    if min_af is not None or max_af is not None:
+        if min_af is None:
+            condition_str = f'AF <= {max_af}'
+        elif max_af is None:
+            condition_str = f'AF >= {min_af}'
+        else:
+            condition_str = f'{min_af} <= AF <= {max_af}'
+        print_log(f'Extract variants with {condition_str}:\t{sample_name}')
+    for df in _read_vcf_table(
+            path=path, include_filtered=include_filtered,
+            chunk_size=chunk_size, **kwargs
+    ):
+        if df.shape[0] == 0:
+            continue
+        df_vcf = df.astype(
+            dtype={k: v for k, v in dtype.items() if k in df.columns}
         )
         if min_af is None and max_af is None:
-            return df_vcf
+            yield df_vcf
         else:
-            if min_af is None:
-                condition_str = f'AF <= {max_af}'
-            elif max_af is None:
-                condition_str = f'AF >= {min_af}'
-            else:
-                condition_str = f'{min_af} <= AF <= {max_af}'
-            print_log(f'Extract variants with {condition_str}:\t{sample_name}')
-            return df_vcf.assign(
+            yield df_vcf.assign(
                 AF=lambda d: _extract_sample_af(df=d, sample_name=sample_name)
             ).pipe(
                 lambda d: (d if min_af is None else d[d['AF'] >= min_af])
@@ -109,81 +216,250 @@ def read_vcf(path, sample_name=None, min_af=None, max_af=None,
 
 def _extract_sample_af(df, sample_name):
     assert sample_name in df.columns, f'column not found: {sample_name}'
-    return df[['FORMAT', sample_name]].apply(
-        lambda r: dict(zip(r[0].split(':'), r[1].split(':'))).get('AF'),
-        axis=1
-    ).astype(float)
-
-
-def _stream_vcf_lines(path, include_filtered=False, **kwargs):
-    columns = None
-    maxsplit = None
-    for s in _open_and_stream_file(path=path, **kwargs):
-        if not s.startswith('#'):
-            assert (columns and maxsplit), 'columns not found'
-            values = s.strip().split('\t', maxsplit=maxsplit)
-            od = OrderedDict(zip(columns, values))
-            if include_filtered or od['FILTER'] in {'PASS', '.'}:
-                yield od
-        elif s.startswith('#CHROM'):
-            columns = s[1:].strip().split('\t')
-            maxsplit = len(columns) - 1
-
-
-def _stream_bed_lines(path, merge=True, bedtools='bedtools', **kwargs):
-    columns = [
+    sr_af = pd.Series(None, index=df.index, dtype=object)
+    for f, i in df.groupby('FORMAT', sort=False).indices.items():
+        keys = f.split(':')
+        if 'AF' in keys:
+            j = keys.index('AF')
+            sr_af.iloc[i] = df[sample_name].iloc[i].str.split(
+                ':', n=(j + 1)
+            ).str[j].to_numpy()
+    return sr_af.astype(float)
+
+
+def _read_vcf_table(path, include_filtered=False, chunk_size=None, n_cpu=1,
+                    **kwargs):
+    with _open_and_stream_file(path=path, n_cpu=n_cpu, **kwargs) as f:
+        columns = None
+        for s in f:
+            if s.startswith(b'#CHROM'):
+                columns = s[1:].decode('utf-8').strip().split('\t')
+                break
+            else:
+                assert s.startswith(b'#'), 'columns not found'
+        assert columns, 'columns not found'
+        yield from _read_tsv(
+            f, names=columns, chunk_size=chunk_size,
+            filters=(None if include_filtered else {'FILTER': ['PASS', '.']}),
+            n_cpu=n_cpu
+        )
+
+
+def _read_bed_table(path, merge=True, columns=None, bedtools=None, n_cpu=1,
+                    **kwargs):
+    bed_columns = [
         'chrom', 'chromStart', 'chromEnd', 'name', 'score', 'strand',
         'thickStart', 'thickEnd', 'itemRgb', 'blockCount', 'blockSizes',
         'blockStarts', 'ADDITIONAL'
     ]
-    maxsplit = len(columns) - 1
-    iters = (
-        _run_and_parse_subprocess(
-            args=f'{bedtools} sort -i {path} | {bedtools} merge -i -',
-            shell=True
-        ) if merge else _open_and_stream_file(path=path, **kwargs)
+    with (
+            _run_and_parse_subprocess(
+                args=f'{bedtools} sort -i {path} | {bedtools} merge -i -',
+                shell=True
+            ) if merge and bedtools
+            else _open_and_stream_file(path=path, n_cpu=n_cpu, **kwargs)
+    ) as f:
+        df_bed = next(
+            _read_tsv(
+                _skip_lines_with_prefixes(
+                    f=f, prefixes=tuple(
+                        p.encode() for p in _BED_HEADER_PREFIXES
+                    )
+                ),
+                skip_prefixes=_BED_HEADER_PREFIXES, usecols=(
+                    [0, 1, 2] if merge and not bedtools
+                    else (
+                        [bed_columns.index(c) for c in columns] if columns
+                        else None
+                    )
+                ),
+                n_cpu=n_cpu
+            )
+        ).rename(columns=dict(enumerate(bed_columns)))
+    if merge and not bedtools:
+        return _merge_bed_intervals(df_bed=df_bed).pipe(
+            lambda d: (d[columns] if columns else d)
+        )
+    else:
+        return df_bed
+
+
+def _merge_bed_intervals(df_bed):
+    if df_bed.shape[0] == 0:
+        return pd.DataFrame(columns=['chrom', 'chromStart', 'chromEnd'])
+    df_sorted = df_bed.astype(
+        dtype={'chrom': str, 'chromStart': np.int64, 'chromEnd': np.int64}
+    ).sort_values(['chrom', 'chromStart'], kind='stable')
+    chroms = df_sorted['chrom'].to_numpy()
+    starts = df_sorted['chromStart'].to_numpy()
+    ends = df_sorted['chromEnd'].to_numpy()
+    max_ends = df_sorted.groupby(
+        'chrom', sort=False
+    )['chromEnd'].cummax().to_numpy()
+    i = np.flatnonzero(
+        np.concatenate([
+            [True],
+            (chroms[1:] != chroms[:-1]) | (starts[1:] > max_ends[:-1])
+        ])
     )
-    for s in iters:
-        if not s.startswith(('browser', 'track')):
-            values = s.strip().split('\t', maxsplit=maxsplit)
-            yield OrderedDict(zip(columns[:len(values)], values))
+    return pd.DataFrame({
+        'chrom': chroms[i], 'chromStart': starts[i],
+        'chromEnd': np.maximum.reduceat(ends, i)
+    })
+
+
+def _skip_lines_with_prefixes(f, prefixes):
+    for line in iter(f.readline, b''):
+        if not line.startswith(prefixes):
+            return io.BufferedReader(
+                _PrefixedStream(prefix=line, stream=f), buffer_size=(1 << 20)
+            )
+    return io.BufferedReader(io.BytesIO())
+
+
+class _PrefixedStream(io.RawIOBase):
+    def __init__(self, prefix, stream):
+        self._prefix = prefix
+        self._stream = stream
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if self._prefix:
+            data = self._prefix[:len(b)]
+            self._prefix = self._prefix[len(data):]
+        else:
+            data = self._stream.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+
+def _read_tsv(f, names=None, usecols=None, chunk_size=None, filters=None,
+              skip_prefixes=None, n_cpu=1):
+    if not f.peek(1):
+        yield pd.DataFrame(columns=(names or list()))
+    elif pacsv:
+        options = {
+            'read_options': pacsv.ReadOptions(
+                column_names=names, autogenerate_column_names=(not names),
+                block_size=(8 << 20), use_threads=(n_cpu > 1)
+            ),
+            'parse_options': pacsv.ParseOptions(
+                delimiter='\t', quote_char=False,
+                invalid_row_handler=(
+                    partial(_handle_invalid_row, prefixes=skip_prefixes)
+                    if skip_prefixes else None
+                )
+            ),
+            'convert_options': pacsv.ConvertOptions(
+                column_types={
+                    n: pa.string()
+                    for n in (names or [f'f{i}' for i in range(256)])
+                },
+                check_utf8=False
+            )
+        }
+        if chunk_size:
+            tables = _group_record_batches(
+                reader=pacsv.open_csv(f, **options), chunk_size=chunk_size
+            )
+        else:
+            tables = [pacsv.read_csv(f, **options)]
+        for t in tables:
+            for p in (skip_prefixes or list()):
+                t = t.filter(pc.invert(pc.starts_with(t[0], pattern=p)))
+            if any(pc.any(pc.equal(a, '')).as_py() for a in t.columns):
+                raise ValueError('empty or missing fields')
+            for k, v in (filters or dict()).items():
+                t = t.filter(pc.is_in(t[k], value_set=pa.array(v)))
+            yield (t.select(usecols) if usecols else t).to_pandas().pipe(
+                lambda d: (
+                    d if names else d.rename(columns=lambda c: int(c[1:]))
+                )
+            )
+    else:
+        df = pd.read_csv(
+            f, sep='\t', header=None, names=names, index_col=False,
+            dtype=str, na_filter=False, quoting=csv.QUOTE_NONE, engine='c',
+            chunksize=chunk_size
+        )
+        for d in (df if chunk_size else [df]):
+            if skip_prefixes:
+                d = d[~d.iloc[:, 0].str.startswith(skip_prefixes)]
+            if (d == '').to_numpy().any():
+                raise ValueError('empty or missing fields')
+            for k, v in (filters or dict()).items():
+                d = d[d[k].isin(v)]
+            yield (
+                d.reset_index(drop=True) if filters or skip_prefixes else d
+            ).pipe(
+                lambda x: (x.iloc[:, usecols] if usecols else x)
+            )
+
+
+def _handle_invalid_row(row, prefixes):
+    return ('skip' if row.text.startswith(prefixes) else 'error')
+
+
+def _group_record_batches(reader, chunk_size):
+    batches = list()
+    n_rows = 0
+    for b in reader:
+        batches.append(b)
+        n_rows += b.num_rows
+        if n_rows >= chunk_size:
+            yield pa.Table.from_batches(batches)
+            batches = list()
+            n_rows = 0
+    if batches:
+        yield pa.Table.from_batches(batches)
 
 
 def _open_and_stream_file(path, bgzip='bgzip', pigz=None, pbzip2=None,
                           n_cpu=1):
     tsv_path = str(path)
     if tsv_path.endswith(('.gz', '.bgz')):
-        if bgzip:
-            f = _run_and_parse_subprocess(
+        if rapidgzip:
+            return io.BufferedReader(
+                rapidgzip.open(tsv_path, parallelization=n_cpu),
+                buffer_size=(1 << 20)
+            )
+        elif bgzip:
+            return _run_and_parse_subprocess(
                 args=[bgzip, '-@', str(n_cpu), '-dc', tsv_path]
             )
         elif pigz:
-            f = _run_and_parse_subprocess(
+            return _run_and_parse_subprocess(
                 args=[pigz, '-p', str(n_cpu), '-dc', tsv_path]
             )
         else:
-            f = gzip.open(tsv_path, mode='rt')
+            return gzip.open(tsv_path, mode='rb')
     elif tsv_path.endswith('.bz2'):
-        if pbzip2:
-            f = _run_and_parse_subprocess(
+        if indexed_bzip2:
+            return indexed_bzip2.open(tsv_path, parallelization=n_cpu)
+        elif pbzip2:
+            return _run_and_parse_subprocess(
                 args=[pbzip2, f'-p{n_cpu}', '-dc', tsv_path]
             )
         else:
-            f = bz2.open(tsv_path, mode='rt')
+            return bz2.open(tsv_path, mode='rb')
     else:
-        f = open(tsv_path, mode='r')
-    for s in f:
-        yield s
+        f = open(tsv_path, mode='rb', buffering=(1 << 20))
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        return f
 
 
+@contextmanager
 def _run_and_parse_subprocess(args, stdout=subprocess.PIPE,
-                              stderr=subprocess.PIPE, **kwargs):
+                              stderr=subprocess.PIPE, bufsize=(1 << 20),
+                              **kwargs):
     logger = logging.getLogger(__name__)
     logger.debug(f'args: {args}')
     with subprocess.Popen(args=args, stdout=stdout, stderr=stderr,
-                          **kwargs) as p:
-        for line in p.stdout:
-            yield line.decode('utf-8')
+                          bufsize=bufsize, **kwargs) as p:
+        yield p.stdout
         o, e = p.communicate()
         if p.returncode == 0:
             pass
@@ -206,6 +482,7 @@ def print_log(message):
 def read_yml(path):
     logger = logging.getLogger(__name__)
     with open(str(path), 'r') as f:
-        d = yaml.load(f, Loader=yaml.FullLoader)
-    logger.debug('YAML data:' + os.linesep + pformat(d))
+        d = yaml.load(f, Loader=YamlLoader)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('YAML data:%s%s', os.linesep, pformat(d))
     return d